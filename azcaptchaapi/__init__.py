@@ -1,28 +1,18 @@
-from __future__ import unicode_literals, print_function, absolute_import, division
-
+import collections
+import functools
+import hashlib
+import os
 import requests
+from requests.adapters import HTTPAdapter
 import time
-import imghdr
-import sys
-
-
-# ----------------------------------------------------------------------------------------------- #
-# [Python version compatibility]                                                                  #
-# ----------------------------------------------------------------------------------------------- #
-
-
-if sys.version_info[0] == 2:
-    from HTMLParser import HTMLParser
-elif sys.version_info[0] == 3:
-    from html.parser import HTMLParser
+import random
+from html import unescape
+from urllib3.util.retry import Retry
 
-
-if sys.version_info[:2] >= (3, 5):
-    # Py3.5 and upwards provide a function directly in the root module.
-    from html import unescape
-else:
-    # For older versions, we use the bound method.
-    unescape = HTMLParser().unescape
+try:
+    from requests_toolbelt import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None
 
 
 # ----------------------------------------------------------------------------------------------- #
@@ -50,6 +40,11 @@ class OperationFailedError(AZCaptchaApiError):
     pass
 
 
+class UnsupportedImageError(AZCaptchaApiError):
+    """The captcha image is in a format we can't detect."""
+    pass
+
+
 # ----------------------------------------------------------------------------------------------- #
 # [Internal convenience decorators]                                                               #
 # ----------------------------------------------------------------------------------------------- #
@@ -57,30 +52,173 @@ class OperationFailedError(AZCaptchaApiError):
 
 def _rewrite_http_to_com_err(func):
     """Rewrites HTTP exceptions from `requests` to `CommunicationError`s."""
+    @functools.wraps(func)
     def proxy(*args, **kwargs):
         try:
             return func(*args, **kwargs)
-        except requests.RequestException:
+        except requests.RequestException as e:
             raise CommunicationError(
                 "an error occurred while communicating with the AZCaptcha API"
-            )
+            ) from e
     return proxy
 
 
 def _rewrite_to_format_err(*exception_types):
     """Rewrites arbitrary exception types to `ResponseFormatError`s."""
     def decorator(func):
+        @functools.wraps(func)
         def proxy(*args, **kwargs):
             try:
                 return func(*args, **kwargs)
-            except Exception as e:
-                if any(isinstance(e, x) for x in exception_types):
-                    raise ResponseFormatError("unexpected response format")
-                raise
+            except exception_types as e:
+                raise ResponseFormatError("unexpected response format") from e
         return proxy
     return decorator
 
 
+def _detect_image_ext(data):
+    """
+    Detects the image format from the leading bytes of `data`, returning the file
+    extension or `None` if the format is not recognized.
+    """
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:2] == b'BM':
+        return 'bmp'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    return None
+
+
+def _response_text(resp):
+    """Decodes a response body as UTF-8, skipping `requests`' charset detection."""
+    resp.encoding = 'utf-8'
+    return resp.text
+
+
+def _prepare_upload(f):
+    """
+    Detects the image format of file object `f` from its header only. Seekable files
+    are rewound and returned as-is so the upload can read straight from them, others
+    are read into memory. Returns a tuple of upload body and file extension.
+    """
+    if getattr(f, 'seekable', lambda: False)():
+        pos = f.tell()
+        header = f.read(32)
+        f.seek(pos)
+        upload = f
+    else:
+        upload = header = f.read()
+
+    file_ext = _detect_image_ext(header)
+    if file_ext is None:
+        raise UnsupportedImageError("unsupported image format")
+    return upload, file_ext
+
+
+def _solve_cache_key(upload, captcha_parameters):
+    """
+    Computes the SHA-256 digest of an upload body together with the sorted solving
+    parameters, so differently parametrised solves of one image don't share answers.
+    File objects are rewound afterwards.
+    """
+    h = hashlib.sha256()
+    params = sorted((str(k), str(v)) for k, v in captcha_parameters.items())
+    h.update(repr(params).encode('utf-8'))
+
+    if isinstance(upload, bytes):
+        h.update(upload)
+        return h.digest()
+
+    pos = upload.tell()
+    for chunk in iter(lambda: upload.read(64 * 1024), b''):
+        h.update(chunk)
+    upload.seek(pos)
+    return h.digest()
+
+
+def _retry_policy(**kwargs):
+    """
+    Builds a `urllib3` retry policy with backoff. Read and status retries only apply
+    to `GET` requests; connect retries ignore the method, which is what allows the
+    same policy to guard `POST` uploads when read and status retries are disabled.
+    """
+    kwargs.setdefault('total', 3)
+    kwargs.setdefault('backoff_factor', 0.3)
+    methods = frozenset(['GET'])
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26 calls it `method_whitelist`.
+        return Retry(method_whitelist=methods, **kwargs)
+
+
+def _backoff_delays(poll_interval, max_interval, backoff):
+    """
+    Yields delays between polls, starting at `poll_interval` and growing by factor
+    `backoff` up to `max_interval`. Each delay is jittered upwards by up to a quarter,
+    so concurrently awaited captchas don't poll in lockstep; the jitter may take a
+    delay past `max_interval`.
+    """
+    interval = poll_interval
+    while True:
+        yield interval + random.uniform(0, 0.25 * interval)
+        interval = min(max_interval, interval * backoff)
+
+
+def _split_many(text, count):
+    """
+    Splits the response to a `get` request for `count` captcha IDs into one
+    (still escaped) value per captcha. Both plain `value|value|..` and
+    `OK|value|OK|value|..` style responses are accepted.
+    """
+    tokens = text.split('|')
+
+    # A single error applies to the whole request, e.g. a wrong API key.
+    if len(tokens) == 1 and tokens[0].startswith('ERROR'):
+        raise OperationFailedError("Operation failed: %r" % (text,))
+
+    if len(tokens) == count:
+        return tokens
+
+    values = []
+    it = iter(tokens)
+    for token in it:
+        values.append(next(it) if token == 'OK' else token)
+    if len(values) != count:
+        raise ValueError("result count doesn't match captcha count")
+    return values
+
+
+def _store_many(captchas, values):
+    """
+    Stores the values split off a `get` response for multiple captchas as their
+    results. Captchas not ready yet are skipped, failures are raised as a single
+    `OperationFailedError` once all successful results were stored.
+    """
+    failed = []
+    for captcha, value in zip(captchas, values):
+        if value in ('CAPCHA_NOT_READY', 'CAPTCHA_NOT_READY'):
+            continue
+        if value.startswith('ERROR'):
+            failed.append((captcha.captcha_id, value))
+            continue
+        captcha._set_result(unescape(value))
+
+    if failed:
+        raise OperationFailedError("Operation failed: %r" % (failed,))
+
+
+# Raw response bodies acknowledging a bad captcha report.
+_REPORT_OK = frozenset((b'OK_REPORT_RECORDED',))
+
+
 # ----------------------------------------------------------------------------------------------- #
 # [Public API]                                                                                    #
 # ----------------------------------------------------------------------------------------------- #
@@ -93,18 +231,65 @@ class AZCaptchaApi(object):
     RES_URL = BASE_URL + '/res.php'
     LOAD_URL = BASE_URL + '/load.php'
 
-    def __init__(self, api_key):
+    # Number of solved images remembered to avoid re-solving identical captchas.
+    SOLVE_CACHE_SIZE = 256
+
+    def __init__(self, api_key, timeout=(5., 30.)):
+        """
+        `timeout` is passed to `requests` for every request, as a
+        `(connect, read)` tuple in seconds.
+        """
+        self.timeout = timeout
+        self._solve_cache = collections.OrderedDict()
+
+        # Keep connections to the API alive between requests, polling hits the same host.
+        # Transient server errors and dropped keep-alive connections are retried.
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=_retry_policy(status_forcelist=(500, 502, 503, 504)),
+        ))
+
+        # Uploads are only retried if the connection couldn't be established. Once the
+        # body is on its way, a retry could queue (and bill) the captcha twice, and a
+        # streamed body can't be rewound anyway.
+        self.session.mount(self.REQ_URL, HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=16,
+            max_retries=_retry_policy(connect=3, read=False, status=0),
+        ))
         self.api_key = api_key
 
+    @property
+    def api_key(self):
+        """The API key, sent along with every request."""
+        return self.session.params['key']
+
+    @api_key.setter
+    def api_key(self, api_key):
+        # Sent along with every request by the session, no need to stamp it into each one.
+        self.session.params['key'] = api_key
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes all pooled connections."""
+        self.session.close()
+
     def get(self, url, params, **kwargs):
         """Sends a HTTP GET, for low-level API interaction."""
-        params['key'] = self.api_key
-        return requests.get(url, params, **kwargs)
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, params=params, **kwargs)
 
     def post(self, url, data, **kwargs):
         """Sends a HTTP POST, for low-level API interaction."""
-        data['key'] = self.api_key
-        return requests.post(url, data, **kwargs)
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, data=data, **kwargs)
 
     @_rewrite_http_to_com_err
     @_rewrite_to_format_err(ValueError)
@@ -112,14 +297,14 @@ class AZCaptchaApi(object):
         """Obtains the balance on our account, in dollars."""
         return float(self.get(self.RES_URL, {
             'action': 'getbalance'
-        }).text)
+        }).content)
 
     @_rewrite_http_to_com_err
     def get_stats(self, date):
         """Obtains statistics about our account, as XML."""
         return self.get(self.RES_URL, {
             'action': 'getstats',
-            'date': date if type(date) == str else date.isoformat(),
+            'date': date if isinstance(date, str) else date.isoformat(),
         }).text
 
     @_rewrite_http_to_com_err
@@ -131,44 +316,120 @@ class AZCaptchaApi(object):
     @_rewrite_to_format_err(IndexError, ValueError)
     def solve(self, file, captcha_parameters=None):
         """
-        Queues a captcha for solving. `file` may either be a path or a file object.
-        Optional parameters for captcha solving may be specified in a `dict` via
+        Queues a captcha for solving. `file` may either be a path (`str` or `os.PathLike`)
+        or a file object. Optional parameters for captcha solving may be specified in a `dict` via
         `captcha_parameters`, for valid values see section "Additional CAPTCHA parameters"
         in API documentation here:
 
         https://azcaptcha.com/
+
+        Images that were solved before with the same parameters are answered from a
+        local cache, returning the captcha of the earlier solve, whose result is
+        immediately available. Reporting it bad drops the image from the cache.
         """
 
-        # If path was provided, load file.
-        if type(file) == str:
-            with open(file, 'rb') as f:
-                raw_data = f.read()
-        else:
-            raw_data = file.read()
+        # If path was provided, open file and stream it from disk.
+        if isinstance(file, (str, os.PathLike)):
+            with open(os.fspath(file), 'rb') as f:
+                return self._solve_file(f, captcha_parameters)
+        return self._solve_file(file, captcha_parameters)
 
-        # Detect image format.
-        file_ext = imghdr.what(None, h=raw_data)
+    @_rewrite_http_to_com_err
+    @_rewrite_to_format_err(ValueError, StopIteration)
+    def poll_many(self, captchas):
+        """
+        Tries to obtain the results of all given captchas using a single request.
+        Results are stored on the captchas, retrieve them via `Captcha.try_get_result`.
+        """
+        pending = [x for x in captchas if x._cached_result is None]
+        if not pending:
+            return
 
-        # Send request.
-        text = self.post(
-            self.REQ_URL,
-            captcha_parameters or {'method': 'post'},
-            files={'file': ('captcha.' + file_ext, raw_data)}
-        ).text
+        text = _response_text(self.get(self.RES_URL, {
+            'action': 'get',
+            'ids': ','.join(x.captcha_id for x in pending),
+        }))
+
+        _store_many(pending, _split_many(text, len(pending)))
+
+    def await_many(self, captchas, initial_wait=5., poll_interval=2., max_interval=10.,
+                   backoff=1.5):
+        """
+        Obtains the texts of all given captchas in a blocking manner, polling them
+        together using `poll_many`. See `Captcha.await_result` for the timing parameters.
+        """
+        if all(x._cached_result is not None for x in captchas):
+            return [x._cached_result for x in captchas]
+
+        time.sleep(initial_wait)
+        for delay in _backoff_delays(poll_interval, max_interval, backoff):
+            self.poll_many(captchas)
+            if all(x._cached_result is not None for x in captchas):
+                return [x._cached_result for x in captchas]
+            time.sleep(delay)
+
+    def _solve_file(self, f, captcha_parameters):
+        """Queues the captcha image in file object `f`, unless it was solved before."""
+        upload, file_ext = _prepare_upload(f)
+        captcha_parameters = captcha_parameters or {'method': 'post'}
+
+        # Seen this image with these parameters before? Hand out the resolved captcha.
+        cache_key = _solve_cache_key(upload, captcha_parameters)
+        cached = self._solve_cache.get(cache_key)
+        if cached is not None:
+            self._solve_cache.move_to_end(cache_key)
+            return cached
+
+        text = self._upload(upload, file_ext, captcha_parameters)
 
         # Success?
-        if '|' in text:
-            _, captcha_id = text.split('|')
-            return Captcha(self, captcha_id)
+        _, sep, captcha_id = text.partition('|')
+        if sep:
+            return Captcha(self, captcha_id, cache_key)
 
         # Nope, failure.
         raise OperationFailedError("Operation failed: %r" % (text,))
 
+    def _upload(self, upload, file_ext, captcha_parameters):
+        """Sends the captcha image to the API, returning the response text."""
+        fields = {name: str(value) for name, value in captcha_parameters.items()}
+        fields['key'] = self.api_key
+        file_field = ('captcha.' + file_ext, upload, 'image/' + file_ext)
+
+        # The key goes into the form body only, keep it out of the upload URL.
+        # Without requests-toolbelt, let requests assemble the multipart body.
+        if MultipartEncoder is None:
+            return _response_text(self.post(
+                self.REQ_URL,
+                fields,
+                files={'file': file_field},
+                params={'key': None},
+                stream=True,
+            ))
+
+        # Otherwise, stream the multipart body chunk-wise straight from the file.
+        fields['file'] = file_field
+        encoder = MultipartEncoder(fields=fields)
+        return _response_text(self.post(
+            self.REQ_URL,
+            encoder,
+            headers={'Content-Type': encoder.content_type},
+            params={'key': None},
+            stream=True,
+        ))
+
+    def _remember_solution(self, cache_key, captcha):
+        """Records a solved captcha in the solve cache, evicting the oldest entries."""
+        self._solve_cache[cache_key] = captcha
+        self._solve_cache.move_to_end(cache_key)
+        while len(self._solve_cache) > self.SOLVE_CACHE_SIZE:
+            self._solve_cache.popitem(last=False)
+
 
 class Captcha(object):
     """Represents a captcha that was queued for solving."""
 
-    def __init__(self, api, captcha_id):
+    def __init__(self, api, captcha_id, cache_key=None):
         """
         Constructs a new captcha awaiting result. Instances should not be created
         manually, but using the `TwoCaptchaApi.solve` method.
@@ -177,9 +438,18 @@ class Captcha(object):
         """
         self.api = api
         self.captcha_id = captcha_id
+        self._poll_params = {'action': 'get', 'id': captcha_id}
+        self._report_params = {'action': 'reportbad', 'id': captcha_id}
+        self._cache_key = cache_key
         self._cached_result = None
         self._reported_bad = False
 
+    def _set_result(self, captcha_text):
+        """Stores the captcha text, remembering it for identical images."""
+        self._cached_result = captcha_text
+        if self._cache_key is not None:
+            self.api._remember_solution(self._cache_key, self)
+
     @_rewrite_http_to_com_err
     @_rewrite_to_format_err(ValueError)
     def try_get_result(self):
@@ -190,15 +460,13 @@ class Captcha(object):
         if self._cached_result is not None:
             return self._cached_result
 
-        text = self.api.get(self.api.RES_URL, {
-            'action': 'get',
-            'id': self.captcha_id,
-        }).text
+        text = _response_text(self.api.get(self.api.RES_URL, self._poll_params))
 
-        # Success?
-        if '|' in text:
-            _, captcha_text = unescape(text).split('|')
-            self._cached_result = captcha_text
+        # Success? Only the answer part needs unescaping.
+        _, sep, captcha_text = text.partition('|')
+        if sep:
+            captcha_text = unescape(captcha_text)
+            self._set_result(captcha_text)
             return captcha_text
 
         # Nope, either failure or not ready, yet. Yep, they mistyped "Captcha".
@@ -208,18 +476,22 @@ class Captcha(object):
         # Failure.
         raise OperationFailedError("Operation failed: %r" % (text,))
 
-    def await_result(self, sleep_time=1.):
+    def await_result(self, initial_wait=5., poll_interval=2., max_interval=10., backoff=1.5):
         """
         Obtains the captcha text in a blocking manner.
-        Retries every `sleep_time` seconds.
+        Waits `initial_wait` seconds before the first attempt, then retries starting
+        at `poll_interval` seconds, growing by factor `backoff` up to `max_interval`.
+        Captchas answered from the solve cache return immediately.
         """
-        while True:
-            # print('Trying to obtain result ..')
+        if self._cached_result is not None:
+            return self._cached_result
+
+        time.sleep(initial_wait)
+        for delay in _backoff_delays(poll_interval, max_interval, backoff):
             result = self.try_get_result()
             if result is not None:
-                break
-            time.sleep(sleep_time)
-        return result
+                return result
+            time.sleep(delay)
 
     @_rewrite_http_to_com_err
     def report_bad(self):
@@ -229,9 +501,11 @@ class Captcha(object):
         if self._reported_bad:
             raise ValueError("tried double-reporting bad captcha")
 
-        resp = self.api.get(self.api.RES_URL, {
-            'action': 'reportbad',
-            'id': self.captcha_id,
-        })
-        if resp.text != 'OK_REPORT_RECORDED':
+        # Don't hand out the wrong answer for this image again.
+        if self._cache_key is not None:
+            self.api._solve_cache.pop(self._cache_key, None)
+
+        resp = self.api.get(self.api.RES_URL, self._report_params)
+        if resp.content.strip() not in _REPORT_OK:
             raise ResponseFormatError("unexpected API response")
+        self._reported_bad = True
@@ -0,0 +1,259 @@
+"""
+Asynchronous variant of the AZCaptcha API, based on `aiohttp`.
+
+Allows awaiting many captchas concurrently on a single event loop, e.g.
+`await asyncio.gather(*[c.await_result() for c in captchas])`.
+"""
+
+import asyncio
+import os
+from html import unescape
+
+import aiohttp
+
+from . import (
+    AZCaptchaApi,
+    CommunicationError,
+    ResponseFormatError,
+    OperationFailedError,
+    _prepare_upload,
+    _backoff_delays,
+    _split_many,
+    _store_many,
+    _REPORT_OK,
+)
+
+
+# Response texts acknowledging a bad captcha report, decoded once from `_REPORT_OK`.
+_REPORT_OK_TEXT = frozenset(x.decode('ascii') for x in _REPORT_OK)
+
+
+class AsyncAZCaptchaApi(object):
+    """Provides an asynchronous interface to the AZCaptcha API."""
+    BASE_URL = AZCaptchaApi.BASE_URL
+    REQ_URL = AZCaptchaApi.REQ_URL
+    RES_URL = AZCaptchaApi.RES_URL
+    LOAD_URL = AZCaptchaApi.LOAD_URL
+
+    def __init__(self, api_key, timeout=(5., 30.)):
+        """
+        `timeout` applies to every request, as a `(connect, read)` tuple in seconds.
+        """
+        self.api_key = api_key
+        self.timeout = timeout
+        self._session = None
+
+    @property
+    def session(self):
+        """The `aiohttp.ClientSession`, created on first use within the running loop."""
+        if self._session is None or self._session.closed:
+            connect, read = self.timeout
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=75),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+            )
+        return self._session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Closes the session and all pooled connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get(self, url, params, **kwargs):
+        """Sends a HTTP GET, for low-level API interaction. Returns the response text."""
+        params = dict(params, key=self.api_key)
+        try:
+            async with self.session.get(url, params=params, **kwargs) as resp:
+                return await resp.text(encoding='utf-8')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise CommunicationError(
+                "an error occurred while communicating with the AZCaptcha API"
+            ) from e
+
+    async def post(self, url, data, **kwargs):
+        """
+        Sends a HTTP POST, for low-level API interaction. Returns the response text.
+        The API key is added to `dict` data; `aiohttp.FormData` is sent as-is and
+        must already contain it.
+        """
+        if not isinstance(data, aiohttp.FormData):
+            data = dict(data, key=self.api_key)
+        try:
+            async with self.session.post(url, data=data, **kwargs) as resp:
+                return await resp.text(encoding='utf-8')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise CommunicationError(
+                "an error occurred while communicating with the AZCaptcha API"
+            ) from e
+
+    async def get_balance(self):
+        """Obtains the balance on our account, in dollars."""
+        text = await self.get(self.RES_URL, {
+            'action': 'getbalance'
+        })
+        try:
+            return float(text)
+        except ValueError as e:
+            raise ResponseFormatError("unexpected response format") from e
+
+    async def get_stats(self, date):
+        """Obtains statistics about our account, as XML."""
+        return await self.get(self.RES_URL, {
+            'action': 'getstats',
+            'date': date if isinstance(date, str) else date.isoformat(),
+        })
+
+    async def get_load(self):
+        """Obtains load statistics of the server."""
+        return await self.get(self.LOAD_URL, {})
+
+    async def solve(self, file, captcha_parameters=None):
+        """
+        Queues a captcha for solving. `file` may either be a path or a file object.
+        See `AZCaptchaApi.solve` for details on `captcha_parameters`.
+        """
+
+        # If path was provided, open file and stream it from disk.
+        if isinstance(file, (str, os.PathLike)):
+            with open(os.fspath(file), 'rb') as f:
+                text = await self._upload(f, captcha_parameters)
+        else:
+            text = await self._upload(file, captcha_parameters)
+
+        # Success?
+        _, sep, captcha_id = text.partition('|')
+        if sep:
+            return AsyncCaptcha(self, captcha_id)
+
+        # Nope, failure.
+        raise OperationFailedError("Operation failed: %r" % (text,))
+
+    async def poll_many(self, captchas):
+        """
+        Tries to obtain the results of all given captchas using a single request.
+        See `AZCaptchaApi.poll_many`.
+        """
+        pending = [x for x in captchas if x._cached_result is None]
+        if not pending:
+            return
+
+        text = await self.get(self.RES_URL, {
+            'action': 'get',
+            'ids': ','.join(x.captcha_id for x in pending),
+        })
+        try:
+            values = _split_many(text, len(pending))
+        except (ValueError, StopIteration) as e:
+            raise ResponseFormatError("unexpected response format") from e
+        _store_many(pending, values)
+
+    async def await_many(self, captchas, initial_wait=5., poll_interval=2., max_interval=10.,
+                         backoff=1.5):
+        """
+        Obtains the texts of all given captchas, polling them together using `poll_many`.
+        See `Captcha.await_result` for the timing parameters.
+        """
+        if all(x._cached_result is not None for x in captchas):
+            return [x._cached_result for x in captchas]
+
+        await asyncio.sleep(initial_wait)
+        for delay in _backoff_delays(poll_interval, max_interval, backoff):
+            await self.poll_many(captchas)
+            if all(x._cached_result is not None for x in captchas):
+                return [x._cached_result for x in captchas]
+            await asyncio.sleep(delay)
+
+    async def _upload(self, f, captcha_parameters):
+        """Sends the captcha image in file object `f` to the API, returning the response text."""
+        upload, file_ext = _prepare_upload(f)
+
+        # Build multipart form.
+        form = aiohttp.FormData()
+        for name, value in (captcha_parameters or {'method': 'post'}).items():
+            form.add_field(name, str(value))
+        form.add_field('key', self.api_key)
+        form.add_field(
+            'file', upload, filename='captcha.' + file_ext, content_type='image/' + file_ext
+        )
+
+        return await self.post(self.REQ_URL, form)
+
+
+class AsyncCaptcha(object):
+    """Represents a captcha that was queued for solving asynchronously."""
+
+    def __init__(self, api, captcha_id):
+        """
+        Constructs a new captcha awaiting result. Instances should not be created
+        manually, but using the `AsyncAZCaptchaApi.solve` method.
+
+        :type api: AsyncAZCaptchaApi
+        """
+        self.api = api
+        self.captcha_id = captcha_id
+        self._poll_params = {'action': 'get', 'id': captcha_id}
+        self._report_params = {'action': 'reportbad', 'id': captcha_id}
+        self._cached_result = None
+        self._reported_bad = False
+
+    def _set_result(self, captcha_text):
+        """Stores the captcha text."""
+        self._cached_result = captcha_text
+
+    async def try_get_result(self):
+        """
+        Tries to obtain the captcha text. If the result is not yet available,
+        `None` is returned.
+        """
+        if self._cached_result is not None:
+            return self._cached_result
+
+        text = await self.api.get(self.api.RES_URL, self._poll_params)
+
+        # Success? Only the answer part needs unescaping.
+        _, sep, captcha_text = text.partition('|')
+        if sep:
+            captcha_text = unescape(captcha_text)
+            self._set_result(captcha_text)
+            return captcha_text
+
+        # Nope, either failure or not ready, yet.
+        if text in ('CAPCHA_NOT_READY', 'CAPTCHA_NOT_READY'):
+            return None
+
+        # Failure.
+        raise OperationFailedError("Operation failed: %r" % (text,))
+
+    async def await_result(self, initial_wait=5., poll_interval=2., max_interval=10., backoff=1.5):
+        """
+        Obtains the captcha text without blocking the event loop.
+        See `Captcha.await_result` for the meaning of the parameters.
+        """
+        if self._cached_result is not None:
+            return self._cached_result
+
+        await asyncio.sleep(initial_wait)
+        for delay in _backoff_delays(poll_interval, max_interval, backoff):
+            result = await self.try_get_result()
+            if result is not None:
+                return result
+            await asyncio.sleep(delay)
+
+    async def report_bad(self):
+        """Reports to the server that the captcha was solved incorrectly."""
+        if self._cached_result is None:
+            raise ValueError("tried reporting bad state for captcha not yet retrieved")
+        if self._reported_bad:
+            raise ValueError("tried double-reporting bad captcha")
+
+        text = await self.api.get(self.api.RES_URL, self._report_params)
+        if text.strip() not in _REPORT_OK_TEXT:
+            raise ResponseFormatError("unexpected API response")
+        self._reported_bad = True
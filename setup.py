@@ -1,10 +1,11 @@
 # -*- coding: utf8 -*-
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='azcaptchaapi',
     version='0.1',
-    packages=['twocaptchaapi'],
+    packages=['azcaptchaapi'],
+    python_requires='>=3.6',
     url='https://github.com/azcaptcha/azcaptchaapi',
     license='MIT',
     author='AZCaptcha by Joel Höner (athre0z)',
@@ -12,6 +13,10 @@ setup(
     description='Python API implementation for AZCaptcha.com',
     download_url='https://github.com/azcaptcha/azcaptchaapi/archive/v0.1.tar.gz',
     install_requires=[
-        'requests>=2.9',
+        'requests>=2.16',
     ],
+    extras_require={
+        'async': ['aiohttp>=3.3'],
+        'streaming': ['requests-toolbelt>=0.8'],
+    },
 )
@@ -0,0 +1,53 @@
+"""Shared fixtures for tests talking to a local stub of the AZCaptcha API."""
+
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+# Large enough that streamed uploads are sent in several chunks.
+PNG_DATA = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64 * 1024
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Base for stub API handlers, answering keep-alive requests quietly."""
+    protocol_version = 'HTTP/1.1'
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(handler):
+    """Serves `handler` on a free local port from a background thread."""
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    server.seen = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def server_url(server):
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def local_api_type(api_type, base_url):
+    """Subclasses `api_type` to send all requests to `base_url`."""
+    return type('Local' + api_type.__name__, (api_type,), {
+        'BASE_URL': base_url,
+        'REQ_URL': base_url + '/in.php',
+        'RES_URL': base_url + '/res.php',
+        'LOAD_URL': base_url + '/load.php',
+    })
@@ -0,0 +1,215 @@
+import asyncio
+import io
+import pathlib
+import socket
+import tempfile
+import time
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+from azcaptchaapi import CommunicationError, OperationFailedError, ResponseFormatError
+
+from support import (
+    PNG_DATA,
+    StubHandler,
+    local_api_type,
+    server_url,
+    start_server,
+    stop_server,
+)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+else:
+    from azcaptchaapi.aio import AsyncAZCaptchaApi, AsyncCaptcha
+
+
+class _ApiHandler(StubHandler):
+    """Answers with the body configured for the request's `action`, or uploads."""
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self.read_body()
+        self.server.seen.append((self.command, url.path, query, body))
+        self.reply(200, self.server.replies[query.get('action', 'upload')])
+
+    do_GET = do_POST = _handle
+
+
+async def _no_sleep(delay):
+    pass
+
+
+@unittest.skipIf(aiohttp is None, 'requires aiohttp')
+class AsyncApiTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server(_ApiHandler)
+        self.server.replies = {}
+        api_type = local_api_type(AsyncAZCaptchaApi, server_url(self.server))
+        self.api = api_type('test-key', timeout=(2., 2.))
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self._run(self.api.close())
+        self.loop.close()
+        stop_server(self.server)
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_get_sends_key(self):
+        self.server.replies['getbalance'] = b'1.5'
+        self.assertEqual(self._run(self.api.get_balance()), 1.5)
+        self.assertEqual(self.server.seen[0][2]['key'], 'test-key')
+
+    def test_get_balance_garbage(self):
+        self.server.replies['getbalance'] = b'nope'
+        with self.assertRaises(ResponseFormatError):
+            self._run(self.api.get_balance())
+
+    def test_connection_errors_wrapped(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        api_type = local_api_type(AsyncAZCaptchaApi, 'http://127.0.0.1:%d' % port)
+        api = api_type('test-key', timeout=(2., 2.))
+        try:
+            with self.assertRaises(CommunicationError) as cm:
+                self._run(api.get(api.RES_URL, {'action': 'getbalance'}))
+            self.assertIsInstance(cm.exception.__cause__, aiohttp.ClientError)
+            with self.assertRaises(CommunicationError):
+                self._run(api.post(api.REQ_URL, {'method': 'post'}))
+        finally:
+            self._run(api.close())
+
+    def test_session_timeout(self):
+        async def session_timeout():
+            return self.api.session.timeout
+
+        timeout = self._run(session_timeout())
+        self.assertEqual((timeout.sock_connect, timeout.sock_read), (2., 2.))
+
+    def test_stalled_socket(self):
+        # Connections are accepted by the kernel, but never answered.
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            s.listen(1)
+            base_url = 'http://127.0.0.1:%d' % s.getsockname()[1]
+            api = local_api_type(AsyncAZCaptchaApi, base_url)('test-key', timeout=(2., 0.2))
+            try:
+                with self.assertRaises(CommunicationError):
+                    self._run(api.get_balance())
+            finally:
+                self._run(api.close())
+
+    def test_solve(self):
+        self.server.replies['upload'] = b'OK|123'
+        captcha = self._run(self.api.solve(io.BytesIO(PNG_DATA), {'numeric': 1}))
+        self.assertIsInstance(captcha, AsyncCaptcha)
+        self.assertEqual(captcha.captcha_id, '123')
+
+        method, path, query, body = self.server.seen[0]
+        self.assertEqual((method, path), ('POST', '/in.php'))
+        self.assertNotIn('key', query)
+        self.assertEqual(body.count(b'test-key'), 1)
+        self.assertIn(PNG_DATA, body)
+        self.assertIn(b'image/png', body)
+
+    def test_solve_from_path(self):
+        self.server.replies['upload'] = b'OK|123'
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'captcha.png')
+            path.write_bytes(PNG_DATA)
+            captcha = self._run(self.api.solve(path))
+        self.assertEqual(captcha.captcha_id, '123')
+        self.assertIn(PNG_DATA, self.server.seen[0][3])
+
+    def test_solve_failure(self):
+        self.server.replies['upload'] = b'ERROR_ZERO_BALANCE'
+        with self.assertRaises(OperationFailedError):
+            self._run(self.api.solve(io.BytesIO(PNG_DATA)))
+
+    def test_try_get_result(self):
+        captcha = AsyncCaptcha(self.api, '123')
+        self.server.replies['get'] = b'CAPCHA_NOT_READY'
+        self.assertIsNone(self._run(captcha.try_get_result()))
+
+        self.server.replies['get'] = b'OK|d&amp;f'
+        self.assertEqual(self._run(captcha.try_get_result()), 'd&f')
+        self.assertEqual(self.server.seen[-1][2]['id'], '123')
+
+        # Known results aren't polled again.
+        self.assertEqual(self._run(captcha.try_get_result()), 'd&f')
+        self.assertEqual(len(self.server.seen), 2)
+
+    def test_try_get_result_failure(self):
+        self.server.replies['get'] = b'ERROR_CAPTCHA_UNSOLVABLE'
+        with self.assertRaises(OperationFailedError):
+            self._run(AsyncCaptcha(self.api, '123').try_get_result())
+
+    def test_poll_many(self):
+        captchas = [AsyncCaptcha(self.api, str(i)) for i in range(3)]
+        self.server.replies['get'] = b'OK|abc|CAPCHA_NOT_READY|ERROR_CAPTCHA_UNSOLVABLE'
+        with self.assertRaises(OperationFailedError):
+            self._run(self.api.poll_many(captchas))
+        self.assertEqual(self.server.seen[0][2]['ids'], '0,1,2')
+        self.assertEqual([x._cached_result for x in captchas], ['abc', None, None])
+
+    def test_poll_many_garbage(self):
+        captchas = [AsyncCaptcha(self.api, str(i)) for i in range(3)]
+        self.server.replies['get'] = b'a|b'
+        with self.assertRaises(ResponseFormatError):
+            self._run(self.api.poll_many(captchas))
+
+    def test_known_results_skip_initial_wait(self):
+        captchas = [AsyncCaptcha(self.api, str(i)) for i in range(2)]
+        for captcha in captchas:
+            captcha._set_result('abc')
+
+        start = time.monotonic()
+        self.assertEqual(self._run(captchas[0].await_result(initial_wait=5.)), 'abc')
+        self.assertEqual(self._run(self.api.await_many(captchas, initial_wait=5.)), ['abc'] * 2)
+        self.assertLess(time.monotonic() - start, 1.)
+        self.assertEqual(self.server.seen, [])
+
+    def test_await_many(self):
+        captchas = [AsyncCaptcha(self.api, str(i)) for i in range(2)]
+        self.server.replies['get'] = b'abc|def'
+        with mock.patch('azcaptchaapi.aio.asyncio.sleep', _no_sleep):
+            result = self._run(self.api.await_many(captchas))
+        self.assertEqual(result, ['abc', 'def'])
+
+    def test_report_bad(self):
+        captcha = AsyncCaptcha(self.api, '123')
+        with self.assertRaises(ValueError):
+            self._run(captcha.report_bad())
+
+        captcha._set_result('abc')
+        self.server.replies['reportbad'] = b'OK_REPORT_RECORDED'
+        self._run(captcha.report_bad())
+        self.assertEqual(self.server.seen[0][2]['id'], '123')
+
+        with self.assertRaises(ValueError):
+            self._run(captcha.report_bad())
+        self.assertEqual(len(self.server.seen), 1)
+
+    def test_report_bad_padded_response(self):
+        captcha = AsyncCaptcha(self.api, '123')
+        captcha._set_result('abc')
+        self.server.replies['reportbad'] = b'OK_REPORT_RECORDED\r\n'
+        self._run(captcha.report_bad())
+
+    def test_report_bad_unexpected_response(self):
+        captcha = AsyncCaptcha(self.api, '123')
+        captcha._set_result('abc')
+        self.server.replies['reportbad'] = b'ERROR_WRONG_CAPTCHA_ID'
+        with self.assertRaises(ResponseFormatError):
+            self._run(captcha.report_bad())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,364 @@
+import io
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+from requests.adapters import BaseAdapter
+
+import azcaptchaapi
+
+from azcaptchaapi import (
+    AZCaptchaApi,
+    Captcha,
+    OperationFailedError,
+    ResponseFormatError,
+    UnsupportedImageError,
+    _backoff_delays,
+    _detect_image_ext,
+    _split_many,
+)
+
+from support import PNG_DATA
+
+
+def _fake_response(body):
+    resp = mock.Mock()
+    resp.content = body.encode('utf-8')
+    resp.text = body
+    return resp
+
+
+class SessionTest(unittest.TestCase):
+    def test_context_manager_closes_session(self):
+        api = AZCaptchaApi('test-key')
+        with mock.patch.object(api.session, 'close') as close:
+            with api as entered:
+                self.assertIs(entered, api)
+                close.assert_not_called()
+            close.assert_called_once_with()
+
+    def test_adapters(self):
+        with AZCaptchaApi('test-key') as api:
+            adapter = api.session.get_adapter(api.RES_URL)
+            self.assertEqual((adapter._pool_connections, adapter._pool_maxsize), (4, 16))
+            self.assertEqual(adapter.max_retries.total, 3)
+            self.assertEqual(set(adapter.max_retries.status_forcelist), {500, 502, 503, 504})
+
+            upload_adapter = api.session.get_adapter(api.REQ_URL)
+            self.assertIsNot(upload_adapter, adapter)
+            self.assertEqual(upload_adapter._pool_maxsize, 16)
+            self.assertEqual(upload_adapter.max_retries.connect, 3)
+            self.assertIs(upload_adapter.max_retries.read, False)
+            self.assertEqual(upload_adapter.max_retries.status, 0)
+
+
+class DetectImageExtTest(unittest.TestCase):
+    SIGNATURES = [
+        (b'\x89PNG\r\n\x1a\n', 'png'),
+        (b'\xff\xd8\xff\xe0', 'jpeg'),
+        (b'GIF87a', 'gif'),
+        (b'GIF89a', 'gif'),
+        (b'BM', 'bmp'),
+        (b'RIFF\x00\x00\x00\x00WEBP', 'webp'),
+        (b'II*\x00', 'tiff'),
+        (b'MM\x00*', 'tiff'),
+    ]
+
+    def test_signatures(self):
+        for header, ext in self.SIGNATURES:
+            with self.subTest(ext=ext):
+                self.assertEqual(_detect_image_ext(header + b'\x00' * 16), ext)
+
+    def test_unknown(self):
+        for data in (b'', b'%PDF-1.4', b'RIFF\x00\x00\x00\x00WAVE'):
+            with self.subTest(data=data):
+                self.assertIsNone(_detect_image_ext(data))
+
+    def test_solve_unsupported(self):
+        with AZCaptchaApi('test-key') as api:
+            with mock.patch.object(api, '_upload') as upload:
+                with self.assertRaises(UnsupportedImageError):
+                    api.solve(io.BytesIO(b'%PDF-1.4' + b'\x00' * 64))
+            upload.assert_not_called()
+
+
+class BackoffTest(unittest.TestCase):
+    def _delays(self, count):
+        delays = _backoff_delays(2., 10., 1.5)
+        return [next(delays) for _ in range(count)]
+
+    def test_schedule(self):
+        with mock.patch('random.uniform', return_value=0.):
+            self.assertEqual(self._delays(6), [2., 3., 4.5, 6.75, 10., 10.])
+
+    def test_jitter(self):
+        with mock.patch('random.uniform', side_effect=lambda a, b: b):
+            self.assertEqual(self._delays(6), [2.5, 3.75, 5.625, 8.4375, 12.5, 12.5])
+
+    def test_await_result_waits_before_first_poll(self):
+        with AZCaptchaApi('test-key') as api:
+            captcha = Captcha(api, '123')
+            with mock.patch.object(captcha, 'try_get_result', side_effect=[None, 'abc']), \
+                    mock.patch('random.uniform', return_value=0.), \
+                    mock.patch('time.sleep') as sleep:
+                self.assertEqual(captcha.await_result(initial_wait=5.), 'abc')
+        self.assertEqual(sleep.call_args_list, [mock.call(5.), mock.call(2.)])
+
+
+class SplitManyTest(unittest.TestCase):
+    def test_plain(self):
+        self.assertEqual(_split_many('abc|def', 2), ['abc', 'def'])
+
+    def test_ok_prefixed(self):
+        self.assertEqual(_split_many('OK|abc|OK|def', 2), ['abc', 'def'])
+
+    def test_mixed_not_ready(self):
+        self.assertEqual(
+            _split_many('OK|abc|CAPCHA_NOT_READY|OK|def', 3),
+            ['abc', 'CAPCHA_NOT_READY', 'def'],
+        )
+        self.assertEqual(
+            _split_many('CAPCHA_NOT_READY|def', 2),
+            ['CAPCHA_NOT_READY', 'def'],
+        )
+
+    def test_global_error(self):
+        with self.assertRaises(OperationFailedError) as cm:
+            _split_many('ERROR_WRONG_USER_KEY', 3)
+        self.assertIn('ERROR_WRONG_USER_KEY', str(cm.exception))
+
+    def test_count_mismatch(self):
+        with self.assertRaises(ValueError):
+            _split_many('abc|def|ghi', 2)
+
+
+class TryGetResultTest(unittest.TestCase):
+    def setUp(self):
+        self.api = AZCaptchaApi('test-key')
+        self.captcha = Captcha(self.api, '123')
+
+    def tearDown(self):
+        self.api.close()
+
+    def _try_get_result(self, body):
+        with mock.patch.object(self.api, 'get', return_value=_fake_response(body)):
+            return self.captcha.try_get_result()
+
+    def test_unescapes(self):
+        self.assertEqual(self._try_get_result('OK|d&amp;f'), 'd&f')
+
+    def test_answer_containing_separator(self):
+        self.assertEqual(self._try_get_result('OK|a|b'), 'a|b')
+
+    def test_not_ready(self):
+        self.assertIsNone(self._try_get_result('CAPCHA_NOT_READY'))
+        self.assertIsNone(self._try_get_result('CAPTCHA_NOT_READY'))
+
+    def test_failure(self):
+        with self.assertRaises(OperationFailedError):
+            self._try_get_result('ERROR_CAPTCHA_UNSOLVABLE')
+
+
+class PollManyTest(unittest.TestCase):
+    def setUp(self):
+        self.api = AZCaptchaApi('test-key')
+        self.captchas = [Captcha(self.api, str(i)) for i in range(3)]
+
+    def tearDown(self):
+        self.api.close()
+
+    def test_stores_results(self):
+        with mock.patch.object(self.api, 'get', return_value=_fake_response(
+            'OK|abc|CAPCHA_NOT_READY|OK|d&amp;f'
+        )) as get:
+            self.api.poll_many(self.captchas)
+        self.assertEqual(get.call_args[0][1]['ids'], '0,1,2')
+        self.assertEqual(
+            [x._cached_result for x in self.captchas],
+            ['abc', None, 'd&f'],
+        )
+
+    def test_global_error(self):
+        with mock.patch.object(self.api, 'get', return_value=_fake_response(
+            'ERROR_KEY_DOES_NOT_EXIST'
+        )):
+            with self.assertRaises(OperationFailedError) as cm:
+                self.api.poll_many(self.captchas)
+        self.assertIn('ERROR_KEY_DOES_NOT_EXIST', str(cm.exception))
+
+    def test_garbage(self):
+        with mock.patch.object(self.api, 'get', return_value=_fake_response('a|b')):
+            with self.assertRaises(ResponseFormatError):
+                self.api.poll_many(self.captchas)
+
+
+class SolveCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.api = AZCaptchaApi('test-key')
+
+    def tearDown(self):
+        self.api.close()
+
+    def _solve(self, captcha_parameters=None):
+        return self.api.solve(io.BytesIO(PNG_DATA), captcha_parameters)
+
+    def test_hit(self):
+        with mock.patch.object(self.api, '_upload', return_value='OK|123') as upload:
+            self._solve({'numeric': 1})._set_result('abc')
+            captcha = self._solve({'numeric': 1})
+        self.assertEqual(upload.call_count, 1)
+        self.assertEqual(captcha.try_get_result(), 'abc')
+
+    def test_parameters_are_part_of_key(self):
+        with mock.patch.object(self.api, '_upload', return_value='OK|123') as upload:
+            self._solve({'numeric': 1})._set_result('abc')
+            captcha = self._solve({'numeric': 2})
+        self.assertEqual(upload.call_count, 2)
+        self.assertIsNone(captcha._cached_result)
+
+    def test_hit_skips_initial_wait(self):
+        with mock.patch.object(self.api, '_upload', return_value='OK|123'):
+            self._solve()._set_result('abc')
+            captchas = [self._solve(), self._solve()]
+        with mock.patch('time.sleep') as sleep:
+            self.assertEqual(captchas[0].await_result(), 'abc')
+            self.assertEqual(self.api.await_many(captchas), ['abc', 'abc'])
+        sleep.assert_not_called()
+
+    def test_hit_blocks_double_report(self):
+        with mock.patch.object(self.api, '_upload', return_value='OK|123'):
+            self._solve()._set_result('abc')
+            first, second = self._solve(), self._solve()
+        with mock.patch.object(self.api, 'get', return_value=_fake_response(
+            'OK_REPORT_RECORDED'
+        )) as get:
+            first.report_bad()
+            with self.assertRaises(ValueError):
+                second.report_bad()
+        self.assertEqual(get.call_count, 1)
+
+        # The reported answer isn't handed out again.
+        with mock.patch.object(self.api, '_upload', return_value='OK|456'):
+            self.assertEqual(self._solve().captcha_id, '456')
+
+    def test_size_bounded(self):
+        self.api.SOLVE_CACHE_SIZE = 2
+        with mock.patch.object(self.api, '_upload', return_value='OK|123'):
+            for i in range(3):
+                self._solve({'numeric': i})._set_result('abc')
+        self.assertEqual(len(self.api._solve_cache), 2)
+
+
+class _RecordingAdapter(BaseAdapter):
+    """
+    Answers every request with a fixed body, recording the prepared requests and
+    their bodies. Streamed bodies are read right away, like a real adapter would.
+    """
+
+    def __init__(self, body):
+        super().__init__()
+        self.body = body
+        self.requests = []
+        self.bodies = []
+        self.timeouts = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        self.timeouts.append(kwargs['timeout'])
+        body = request.body
+        self.bodies.append(body.read() if hasattr(body, 'read') else body)
+        resp = requests.Response()
+        resp.status_code = 200
+        resp._content = self.body
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+class ApiKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.api = AZCaptchaApi('test-key')
+        self.adapter = _RecordingAdapter(b'OK|123')
+        self.api.session.mount('http://', self.adapter)
+        self.api.session.mount(self.api.REQ_URL, self.adapter)
+
+    def tearDown(self):
+        self.api.close()
+
+    def test_get_sends_key_without_mutating_params(self):
+        params = {'action': 'get', 'id': '1'}
+        self.api.get(self.api.RES_URL, params)
+        self.assertEqual(params, {'action': 'get', 'id': '1'})
+        self.assertIn('key=test-key', self.adapter.requests[0].url)
+
+    def _check_upload_sends_key_once(self):
+        self.api.solve(io.BytesIO(PNG_DATA), {'numeric': 1})
+        self.assertNotIn('key=', self.adapter.requests[0].url)
+        self.assertEqual(self.adapter.bodies[0].count(b'test-key'), 1)
+
+    def test_solve_from_path(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'captcha.png')
+            path.write_bytes(PNG_DATA)
+            self.assertEqual(self.api.solve(path).captcha_id, '123')
+        self.assertIn(PNG_DATA, self.adapter.bodies[0])
+
+    def test_upload_sends_key_once(self):
+        self._check_upload_sends_key_once()
+
+    def test_upload_sends_key_once_without_toolbelt(self):
+        with mock.patch.object(azcaptchaapi, 'MultipartEncoder', None):
+            self._check_upload_sends_key_once()
+
+    def test_setter_keeps_other_session_params(self):
+        self.api.session.params['soft_id'] = '42'
+        self.api.api_key = 'other-key'
+        self.assertEqual(self.api.session.params, {'key': 'other-key', 'soft_id': '42'})
+
+
+class ResponseParsingTest(unittest.TestCase):
+    def setUp(self):
+        self.api = AZCaptchaApi('test-key')
+
+    def tearDown(self):
+        self.api.close()
+
+    def _respond_with(self, body):
+        adapter = _RecordingAdapter(body)
+        self.api.session.mount('http://', adapter)
+        self.api.session.mount(self.api.REQ_URL, adapter)
+        return adapter
+
+    def test_get_balance(self):
+        self._respond_with(b'1.5\r\n')
+        self.assertEqual(self.api.get_balance(), 1.5)
+
+    def test_get_balance_garbage(self):
+        self._respond_with(b'nope')
+        with self.assertRaises(ResponseFormatError):
+            self.api.get_balance()
+
+    def test_default_timeout(self):
+        adapter = self._respond_with(b'OK|123')
+        self.api.get(self.api.RES_URL, {'action': 'getbalance'})
+        self.api.solve(io.BytesIO(PNG_DATA))
+        self.assertEqual(adapter.timeouts, [(5., 30.), (5., 30.)])
+
+    def test_timeout_override(self):
+        adapter = self._respond_with(b'OK|123')
+        self.api.timeout = (1., 2.)
+        self.api.get(self.api.RES_URL, {'action': 'getbalance'})
+        self.api.post(self.api.REQ_URL, {'method': 'post'}, timeout=3.)
+        self.assertEqual(adapter.timeouts, [(1., 2.), 3.])
+
+    def test_results_decoded_as_utf8(self):
+        self._respond_with('OK|Grüße'.encode('utf-8'))
+        self.assertEqual(Captcha(self.api, '123').try_get_result(), 'Grüße')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import io
+import unittest
+from unittest import mock
+
+import azcaptchaapi
+from azcaptchaapi import AZCaptchaApi, OperationFailedError
+
+from support import (
+    PNG_DATA,
+    StubHandler,
+    local_api_type,
+    server_url,
+    start_server,
+    stop_server,
+)
+
+
+class _FlakyHandler(StubHandler):
+    """Fails the first request to every path with a 503, answers later ones."""
+
+    def _handle(self):
+        path = self.path.split('?')[0]
+        body = self.read_body()
+        self.server.seen.append((self.command, path, body))
+
+        if sum(1 for x in self.server.seen if x[1] == path) == 1:
+            self.reply(503, b'Service Unavailable')
+        elif path == '/in.php':
+            self.reply(200, b'OK|123')
+        else:
+            self.reply(200, b'1.5')
+
+    do_GET = do_POST = _handle
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server(_FlakyHandler)
+        api_type = local_api_type(AZCaptchaApi, server_url(self.server))
+        self.api = api_type('test-key', timeout=(2., 2.))
+
+    def tearDown(self):
+        self.api.close()
+        stop_server(self.server)
+
+    def test_get_retried_on_5xx(self):
+        self.assertEqual(self.api.get_balance(), 1.5)
+        self.assertEqual([x[0] for x in self.server.seen], ['GET', 'GET'])
+
+    def _check_upload_not_retried(self):
+        with self.assertRaises(OperationFailedError):
+            self.api.solve(io.BytesIO(PNG_DATA))
+
+        # Exactly one upload, carrying the complete image.
+        self.assertEqual(len(self.server.seen), 1)
+        method, _, body = self.server.seen[0]
+        self.assertEqual(method, 'POST')
+        self.assertIn(PNG_DATA, body)
+
+        # The next upload goes through on a fresh attempt.
+        self.assertEqual(self.api.solve(io.BytesIO(PNG_DATA)).captcha_id, '123')
+
+    @unittest.skipIf(azcaptchaapi.MultipartEncoder is None, 'requires requests-toolbelt')
+    def test_streamed_upload_not_retried_on_5xx(self):
+        self._check_upload_not_retried()
+
+    def test_upload_not_retried_on_5xx_without_toolbelt(self):
+        with mock.patch.object(azcaptchaapi, 'MultipartEncoder', None):
+            self._check_upload_not_retried()
+
+
+if __name__ == '__main__':
+    unittest.main()